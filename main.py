@@ -1,6 +1,6 @@
 import os
 import logging
-from typing import Annotated, Dict
+from typing import Annotated, Dict, List
 from typing_extensions import TypedDict
 from uuid import uuid4
 
@@ -8,17 +8,18 @@ from flask import Flask, request, render_template, jsonify
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
-from langchain_core.messages import HumanMessage, ToolMessage
+from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.graph import StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 
 # --- Import Agent Tools ---
-from tools.analyze_id_card import analyze_id_card_tool
+from tools.analyze_id_card import analyze_id_cards_batch_tool
 from tools.database_check import database_check_tool
 from tools.notify_fraud import notify_fraud_tool
-from tools.query_database import query_database_tool # <-- NEW TOOL
+from tools.query_database import query_database_tool, format_records_table # <-- NEW TOOL
+from message_compaction import compact_messages, make_tool_message, log_token_usage
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -36,7 +37,7 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # --- Agent State Definition ---
 class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
-    extracted_data: Dict[str, str] | None
+    extracted_data: List[Dict[str, str]] | None
 
 # --- Setup LLM ---
 try:
@@ -48,7 +49,7 @@ except Exception as e:
 # ==============================================================================
 # WORKFLOW 1: FRAUD DETECTION AGENT
 # ==============================================================================
-fraud_tools = [analyze_id_card_tool, database_check_tool, notify_fraud_tool]
+fraud_tools = [analyze_id_cards_batch_tool, database_check_tool, notify_fraud_tool]
 llm_with_fraud_tools = llm.bind_tools(fraud_tools) if llm else None
 
 fraud_system_prompt = (
@@ -56,9 +57,10 @@ fraud_system_prompt = (
     "Your workflow is strictly defined and must be followed precisely. You must answer in Bahasa Indonesia"
     "\n"
     "--- WORKFLOW ---"
-    "1.  **Analyze Image**: You will be given the path to an ID card image. Your first action is to call `analyze_id_card_tool`."
-    "2.  **Check Database**: Take the extracted details and use `database_check_tool`."
-    "3.  **Handle Outcome**: "
+    "1.  **Analyze Image**: You will be given the path to an ID card image. Your first action is to call `analyze_id_cards_batch_tool` with that path as the only entry in `image_paths`."
+    "    The photo may contain several ID cards; the tool returns one result per detected card."
+    "2.  **Check Database**: For EACH result with status 'success', take its extracted details and use `database_check_tool`."
+    "3.  **Handle Outcome** (for each card): "
     "    - If the status is 'duplicate', you MUST call `notify_fraud_tool`."
     "    - If the status is 'new_record_added' or 'error', your job is complete."
     "4.  **Report**: Provide a final, concise summary of the actions taken and the result."
@@ -66,8 +68,9 @@ fraud_system_prompt = (
 )
 
 def fraud_agent_node(state: AgentState):
-    messages = [HumanMessage(content=fraud_system_prompt)] + state['messages']
+    messages = compact_messages(fraud_system_prompt, state['messages'])
     response = llm_with_fraud_tools.invoke(messages)
+    log_token_usage("fraud_agent", llm, fraud_system_prompt, state['messages'], messages, response)
     return {"messages": [response]}
 
 def fraud_tool_node(state: AgentState):
@@ -80,11 +83,14 @@ def fraud_tool_node(state: AgentState):
         selected_tool = next((t for t in fraud_tools if t.name == tool_name), None)
         if selected_tool:
             output = selected_tool.invoke(tool_args)
-            if tool_name == 'analyze_id_card_tool' and output.get("status") == "success":
-                state_updates['extracted_data'] = {k: v for k, v in output.items() if k != 'status'}
+            if tool_name == 'analyze_id_cards_batch_tool' and output.get("status") in ("success", "partial"):
+                state_updates['extracted_data'] = [
+                    {key: result[key] for key in ("identity_number", "full_name", "date_of_birth")}
+                    for result in output["results"] if result["status"] == "success"
+                ]
         else:
             output = f"Error: Tool '{tool_name}' not found."
-        tool_outputs.append(ToolMessage(content=str(output), tool_call_id=call['id']))
+        tool_outputs.append(make_tool_message(output, call['id']))
     return {"messages": tool_outputs, **state_updates}
 
 # ==============================================================================
@@ -101,8 +107,9 @@ chat_system_prompt = (
 )
 
 def chat_agent_node(state: AgentState):
-    messages = [HumanMessage(content=chat_system_prompt)] + state['messages']
+    messages = compact_messages(chat_system_prompt, state['messages'])
     response = llm_with_chat_tools.invoke(messages)
+    log_token_usage("chat_agent", llm, chat_system_prompt, state['messages'], messages, response)
     return {"messages": [response]}
 
 def chat_tool_node(state: AgentState):
@@ -110,7 +117,8 @@ def chat_tool_node(state: AgentState):
     tool_outputs = []
     for call in tool_calls:
         output = query_database_tool.invoke(call.get('args', {}))
-        tool_outputs.append(ToolMessage(content=str(output), tool_call_id=call['id']))
+        baseline = format_records_table(output) if isinstance(output, list) else None
+        tool_outputs.append(make_tool_message(output, call['id'], baseline))
     return {"messages": tool_outputs}
 
 # --- Graph Definitions ---
@@ -136,6 +144,12 @@ chat_graph_builder.add_edge("tools", "agent")
 chat_graph = chat_graph_builder.compile()
 
 # --- Flask Routes ---
+@app.errorhandler(413)
+def request_too_large(e):
+    # The front-end expects JSON; Flask's default 413 page is HTML.
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"error": f"Upload too large. Each request may carry at most {limit_mb}MB of images."}), 413
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -164,6 +178,67 @@ def upload_file():
     os.remove(filepath)
     return jsonify({"response": final_response or "Agent did not produce a final response."})
 
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    Handles bulk uploads. All images go through analyze_id_cards_batch_tool, which packs several
+    images into each model request; every extracted card is then checked against the database
+    directly, without an agent turn per card.
+    """
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files or not llm:
+        return jsonify({"error": "Invalid request or LLM not initialized"}), 400
+
+    filepaths, filenames = [], {}
+    for file in files:
+        filename = secure_filename(file.filename)
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid4()}_{filename}")
+        file.save(filepath)
+        filepaths.append(filepath)
+        filenames[filepath] = filename
+
+    try:
+        batch_output = analyze_id_cards_batch_tool.invoke({"image_paths": filepaths})
+    finally:
+        for filepath in filepaths:
+            os.remove(filepath)
+
+    if "results" not in batch_output:
+        return jsonify({"error": batch_output.get("error", "Batch analysis failed.")}), 500
+
+    lines = []
+    for result in batch_output["results"]:
+        result["image_path"] = filenames[result["image_path"]]
+        label = result["image_path"] if "card_index" not in result else f"{result['image_path']} #{result['card_index'] + 1}"
+        if result["status"] != "success":
+            lines.append(f"{label}: error - {result['error']}")
+            continue
+        card = {key: result[key] for key in ("identity_number", "full_name", "date_of_birth")}
+        try:
+            check = database_check_tool.invoke(card)
+            result["database_status"] = check["status"]
+            if check["status"] == "duplicate":
+                notification = notify_fraud_tool.invoke(card)
+                result["notification_status"] = notification["status"]
+        except Exception as e:
+            # One bad card must not abort the rest of the batch after earlier cards were recorded.
+            logger.error(f"Failed to check card {label}: {e}")
+            result["database_status"] = "error"
+            lines.append(f"{label}: {card['full_name']} ({card['identity_number']}) - error - {e}")
+            continue
+        if check["status"] == "duplicate":
+            lines.append(f"{label}: {card['full_name']} ({card['identity_number']}) - duplicate, fraud notification {notification['status']}")
+        elif check["status"] == "new_record_added":
+            lines.append(f"{label}: {card['full_name']} ({card['identity_number']}) - new record added")
+        else:
+            lines.append(f"{label}: {card['full_name']} ({card['identity_number']}) - error - {check['error']}")
+
+    return jsonify({
+        "response": "\n".join(lines),
+        "model_calls": batch_output["model_calls"],
+        "results": batch_output["results"],
+    })
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handles chat inquiries from the user."""
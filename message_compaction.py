@@ -0,0 +1,129 @@
+import json
+import logging
+from typing import Any, List
+
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+# --- Configuration ---
+# Tool results from this many of the most recent tool rounds (one AIMessage and the
+# results of its tool calls) are always sent verbatim.
+KEEP_RECENT_TOOL_ROUNDS = 2
+# Older tool results longer than this many characters are replaced with a short summary.
+MAX_STALE_TOOL_CHARS = 200
+# Keys that only repeat what 'status' already says; dropped from tool results.
+VERBOSE_KEYS = ("message",)
+# Keys kept when a stale dict result is summarized.
+SUMMARY_KEYS = ("status", "error")
+
+# --- Configure Logging ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def _to_json(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def compact_tool_output(output: Any) -> str:
+    """
+    Serializes a tool result as compact, canonical JSON for a ToolMessage.
+    Dict results lose their verbose keys when a 'status' is present; plain strings pass through.
+    """
+    if isinstance(output, str):
+        return output
+    if isinstance(output, dict) and "status" in output:
+        output = {k: v for k, v in output.items() if k not in VERBOSE_KEYS}
+    return _to_json(output)
+
+
+def make_tool_message(output: Any, tool_call_id: str, baseline: str | None = None) -> ToolMessage:
+    """
+    Wraps a tool result in a compact ToolMessage. The content the previous loop would have sent
+    (str(output) unless 'baseline' is given) is kept in the message artifact, which is never
+    sent to the model, so the baseline cost can be counted.
+    """
+    return ToolMessage(
+        content=compact_tool_output(output),
+        tool_call_id=tool_call_id,
+        artifact={"baseline_content": str(output) if baseline is None else baseline},
+    )
+
+
+def _summarize_stale(content: str) -> str:
+    """
+    Replaces a stale tool result with a short, deterministic summary. JSON results stay
+    valid JSON: dicts keep only their summary keys, lists keep only their length.
+    """
+    if len(content) <= MAX_STALE_TOOL_CHARS:
+        return content
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError:
+        return f"{content[:MAX_STALE_TOOL_CHARS]}…[truncated {len(content) - MAX_STALE_TOOL_CHARS} chars]"
+    if isinstance(parsed, dict):
+        summary = {k: parsed[k] for k in SUMMARY_KEYS if k in parsed}
+        summary["omitted_keys"] = sorted(k for k in parsed if k not in SUMMARY_KEYS)
+        return _to_json(summary)
+    if isinstance(parsed, list):
+        return _to_json({"omitted_items": len(parsed)})
+    return content
+
+
+def compact_messages(system_prompt: str, messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    Builds the message list sent to the model on each agent turn.
+    The system prompt goes first as a SystemMessage, so it is a stable prefix for provider-side
+    caching. Only that prefix is guaranteed stable: tool results are summarized once their round
+    falls out of the most recent KEEP_RECENT_TOOL_ROUNDS, which changes the history after that point.
+    The graph state itself is left untouched.
+    """
+    # Tool results before the AIMessage that opened the oldest kept round are stale; the current
+    # round always follows the last AIMessage, so it is never summarized.
+    ai_indices = [i for i, m in enumerate(messages) if isinstance(m, AIMessage)]
+    cutoff = ai_indices[-KEEP_RECENT_TOOL_ROUNDS] if len(ai_indices) >= KEEP_RECENT_TOOL_ROUNDS else 0
+
+    compacted: List[BaseMessage] = [SystemMessage(content=system_prompt)]
+    for i, message in enumerate(messages):
+        if i < cutoff and isinstance(message, ToolMessage) and isinstance(message.content, str):
+            message = message.model_copy(update={"content": _summarize_stale(message.content)})
+        compacted.append(message)
+    return compacted
+
+
+def baseline_messages(system_prompt: str, messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    Rebuilds the same turn as sent by the loop before compaction: the system prompt as a
+    HumanMessage and every tool result in the form recorded by make_tool_message.
+    """
+    baseline: List[BaseMessage] = [HumanMessage(content=system_prompt)]
+    for message in messages:
+        artifact = getattr(message, "artifact", None)
+        if isinstance(message, ToolMessage) and isinstance(artifact, dict) and "baseline_content" in artifact:
+            message = message.model_copy(update={"content": artifact["baseline_content"]})
+        baseline.append(message)
+    return baseline
+
+
+def _count_tokens(llm: BaseLanguageModel, messages: List[BaseMessage]) -> int | str:
+    try:
+        return llm.get_num_tokens_from_messages(messages)
+    except Exception as e:
+        logger.warning(f"Could not count tokens: {e}")
+        return "n/a"
+
+
+def log_token_usage(agent_name: str, llm: BaseLanguageModel, system_prompt: str, history: List[BaseMessage], sent: List[BaseMessage], response: Any) -> None:
+    """
+    Logs per-turn input token counts. 'provider_input_tokens' (and 'cached') are what the provider
+    billed for the request, including tool schemas. 'counted_baseline' and 'counted_compacted'
+    are measured with the same model token counter on the pre-compaction and compacted message
+    lists, so their difference is the saving per turn.
+    """
+    usage = getattr(response, "usage_metadata", None) or {}
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    logger.info(
+        f"[{agent_name}] provider_input_tokens={usage.get('input_tokens', 'n/a')} cached={cached} "
+        f"counted_baseline={_count_tokens(llm, baseline_messages(system_prompt, history))} "
+        f"counted_compacted={_count_tokens(llm, sent)}"
+    )
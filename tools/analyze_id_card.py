@@ -1,7 +1,7 @@
 import os
 import base64
 import logging
-from typing import Dict
+from typing import Any, Dict, List, Tuple
 
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
@@ -15,11 +15,57 @@ import json
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def _positive_int_setting(name: str, default: int) -> int:
+    """Reads a positive integer from the environment, falling back to the default if invalid."""
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        logger.warning(f"Invalid {name}={raw!r}; expected a positive integer. Using default {default}.")
+        return default
+    return value
+
+# --- Configuration ---
+REQUIRED_KEYS = ["identity_number", "full_name", "date_of_birth"]
+# Maximum number of images packed into one batched Gemini request.
+BATCH_SIZE = _positive_int_setting("ID_BATCH_SIZE", 8)
+# Cap on the combined base64 payload of one batched request (Gemini inline data limit is 20 MB).
+BATCH_MAX_BYTES = _positive_int_setting("ID_BATCH_MAX_BYTES", 15 * 1024 * 1024)
+
 # --- Pydantic Schema for Tool Input ---
 class AnalyzeIdCardInput(BaseModel):
     """Input schema for the ID card analysis tool."""
     image_path: str = Field(description="The file path to the ID card image to be analyzed.")
 
+class AnalyzeIdCardsBatchInput(BaseModel):
+    """Input schema for the batched ID card analysis tool."""
+    image_paths: List[str] = Field(description="The file paths to the ID card images to be analyzed.")
+
+# --- Shared Helpers ---
+def _encode_image(image_path: str) -> str:
+    """Opens an image and returns it as a base64-encoded PNG string."""
+    # Open the image and convert it to a compatible format (e.g., PNG)
+    with Image.open(image_path) as img:
+        byte_arr = io.BytesIO()
+        img.convert("RGB").save(byte_arr, format='PNG')
+        return base64.b64encode(byte_arr.getvalue()).decode('utf-8')
+
+def _image_part(image_b64: str) -> Dict[str, Any]:
+    return {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
+
+def _parse_json_response(response_content: str) -> Any:
+    """Parses the model's response as JSON, stripping the ```json fence it sometimes adds."""
+    if "```json" in response_content:
+        response_content = response_content.split("```json")[1].split("```")[0].strip()
+    return json.loads(response_content)
+
+def _is_valid_record(record: Any) -> bool:
+    return isinstance(record, dict) and all(isinstance(record.get(key), str) and record[key] for key in REQUIRED_KEYS)
+
 # --- The Tool Definition ---
 @tool("analyze_id_card_tool", args_schema=AnalyzeIdCardInput)
 def analyze_id_card_tool(image_path: str) -> Dict[str, str]:
@@ -41,16 +87,7 @@ def analyze_id_card_tool(image_path: str) -> Dict[str, str]:
 
     # --- Prepare the Image and Prompt for the Model ---
     try:
-        # Open the image and convert it to a compatible format (e.g., PNG)
-        with Image.open(image_path) as img:
-            # Convert image to bytes
-            byte_arr = io.BytesIO()
-            img.convert("RGB").save(byte_arr, format='PNG')
-            image_bytes = byte_arr.getvalue()
-            
-            # Encode image in base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-
+        image_b64 = _encode_image(image_path)
     except Exception as e:
         logger.error(f"Failed to process the image: {e}")
         return {"status": "error", "error": f"Invalid or corrupted image file: {image_path}"}
@@ -72,10 +109,7 @@ def analyze_id_card_tool(image_path: str) -> Dict[str, str]:
     message = HumanMessage(
         content=[
             {"type": "text", "text": prompt_text},
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{image_b64}"},
-            },
+            _image_part(image_b64),
         ]
     )
 
@@ -86,18 +120,12 @@ def analyze_id_card_tool(image_path: str) -> Dict[str, str]:
         
         # The response content should be a JSON string
         response_content = response.content
-        
-        # Clean the response to ensure it is valid JSON
-        # The model sometimes wraps the JSON in ```json ... ```
-        if "```json" in response_content:
-            response_content = response_content.split("```json")[1].split("```")[0].strip()
 
         # Parse the JSON string into a Python dictionary
-        extracted_data = json.loads(response_content)
+        extracted_data = _parse_json_response(response_content)
         
         # --- Validate the Extracted Data ---
-        required_keys = ["identity_number", "full_name", "date_of_birth"]
-        if not all(key in extracted_data for key in required_keys):
+        if not all(key in extracted_data for key in REQUIRED_KEYS):
             raise ValueError("The model did not return all the required fields.")
 
         extracted_data["status"] = "success"
@@ -112,3 +140,139 @@ def analyze_id_card_tool(image_path: str) -> Dict[str, str]:
         logger.error(f"An unexpected error occurred during model invocation: {e}")
         return {"status": "error", "error": str(e)}
 
+# --- Batched Extraction ---
+def _chunk_images(encoded: List[Tuple[int, str, str]]) -> List[List[Tuple[int, str, str]]]:
+    """Groups (input_index, image_path, image_b64) entries into batches capped by BATCH_SIZE and BATCH_MAX_BYTES."""
+    batches, current, current_bytes = [], [], 0
+    for item in encoded:
+        size = len(item[2])
+        if current and (len(current) >= BATCH_SIZE or current_bytes + size > BATCH_MAX_BYTES):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(item)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def _extract_batch(llm: ChatGoogleGenerativeAI, batch: List[Tuple[int, str, str]]) -> Tuple[Dict[int, List[Dict[str, str]]], Dict[int, int]]:
+    """
+    Sends one batch of images in a single request. Returns the valid card records and the
+    number of discarded (invalid) card records, both keyed by the image's position in the batch.
+    Images the model returned nothing for are absent from both.
+    """
+    prompt_text = f"""
+    You are given {len(batch)} images, each preceded by a label "Image <index>".
+    Each image may contain one or more ID cards. For EVERY ID card you detect, extract:
+    1.  "identity_number": The national identity number (e.g., NIK in Indonesia).
+    2.  "full_name": The full name of the person.
+    3.  "date_of_birth": The date of birth.
+
+    Return ONLY a valid JSON array with one object per detected card, like this:
+    [{{"image_index": 0, "identity_number": "...", "full_name": "...", "date_of_birth": "..."}}]
+    Use the index from the image's label. Omit images in which no card can be read.
+    Do not include any other text or explanations.
+    """
+    content: List[Dict[str, Any]] = [{"type": "text", "text": prompt_text}]
+    for index, (_, _, image_b64) in enumerate(batch):
+        content.append({"type": "text", "text": f"Image {index}"})
+        content.append(_image_part(image_b64))
+
+    records: Dict[int, List[Dict[str, str]]] = {}
+    discarded: Dict[int, int] = {}
+    try:
+        logger.info(f"Sending a batch of {len(batch)} images to Gemini for analysis...")
+        response = llm.invoke([HumanMessage(content=content)])
+        parsed = _parse_json_response(response.content)
+    except Exception as e:
+        logger.error(f"Batched extraction failed, falling back to single-image requests: {e}")
+        return records, discarded
+
+    if not isinstance(parsed, list):
+        logger.error("Batched extraction did not return a JSON array, falling back to single-image requests.")
+        return records, discarded
+
+    for item in parsed:
+        index = item.get("image_index") if isinstance(item, dict) else None
+        if isinstance(index, str) and index.isdigit():
+            index = int(index)
+        if not isinstance(index, int) or not 0 <= index < len(batch):
+            logger.warning(f"Discarding batch item with no valid image_index: {item}")
+            continue
+        if not _is_valid_record(item):
+            logger.warning(f"Discarding invalid batch item for image {index}: {item}")
+            discarded[index] = discarded.get(index, 0) + 1
+            continue
+        records.setdefault(index, []).append({key: item[key] for key in REQUIRED_KEYS})
+    return records, discarded
+
+@tool("analyze_id_cards_batch_tool", args_schema=AnalyzeIdCardsBatchInput)
+def analyze_id_cards_batch_tool(image_paths: List[str]) -> Dict[str, Any]:
+    """
+    Analyzes several ID card images with as few model requests as possible, packing multiple
+    images into each request. A photo containing several cards yields one record per card.
+    Images with a missing or invalid card record are retried individually with the same
+    multi-card prompt; cards that still cannot be extracted are reported as error entries.
+    Results follow the order of image_paths.
+    """
+    if not image_paths:
+        return {"status": "error", "error": "No image paths were provided."}
+
+    outcomes: Dict[int, List[Dict[str, Any]]] = {}
+    encoded: List[Tuple[int, str, str]] = []
+    for input_index, image_path in enumerate(image_paths):
+        if not os.path.exists(image_path):
+            outcomes[input_index] = [{"status": "error", "error": f"File not found at path: {image_path}"}]
+            continue
+        try:
+            encoded.append((input_index, image_path, _encode_image(image_path)))
+        except Exception as e:
+            logger.error(f"Failed to process the image: {e}")
+            outcomes[input_index] = [{"status": "error", "error": f"Invalid or corrupted image file: {image_path}"}]
+
+    model_calls = 0
+    if encoded:
+        try:
+            llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
+        except Exception as e:
+            logger.error(f"Failed to initialize the language model: {e}")
+            return {"status": "error", "error": "Could not initialize Gemini model. Check API key."}
+
+        for batch in _chunk_images(encoded):
+            records, discarded = _extract_batch(llm, batch)
+            model_calls += 1
+            for index, item in enumerate(batch):
+                input_index, image_path, _ = item
+                cards = records.get(index, [])
+                dropped = discarded.get(index, 0)
+                if not cards or dropped:
+                    # --- Single-image retry for images the batch could not fully extract ---
+                    # The retry is a batch of one, so it uses the same multi-card prompt and validation.
+                    logger.info(f"Retrying '{image_path}' as a single-image request...")
+                    retry_records, retry_discarded = _extract_batch(llm, [item])
+                    model_calls += 1
+                    known = {card["identity_number"] for card in cards}
+                    recovered = [card for card in retry_records.get(0, []) if card["identity_number"] not in known]
+                    cards += recovered
+                    dropped = max(dropped - len(recovered), retry_discarded.get(0, 0))
+                    if not cards and not dropped:
+                        outcomes[input_index] = [{"status": "error", "error": "No ID card could be extracted from the image."}]
+                        continue
+                entries = [{"card_index": card_index, "status": "success", **card} for card_index, card in enumerate(cards)]
+                entries += [{"status": "error", "error": "A detected card could not be extracted."}] * dropped
+                outcomes[input_index] = entries
+
+    results = [
+        {"input_index": input_index, "image_path": image_paths[input_index], **entry}
+        for input_index in sorted(outcomes)
+        for entry in outcomes[input_index]
+    ]
+    extracted = sum(1 for r in results if r["status"] == "success")
+    if extracted == len(results):
+        status = "success"
+    elif extracted == 0:
+        status = "error"
+    else:
+        status = "partial"
+    logger.info(f"Extracted {extracted} cards from {len(image_paths)} images in {model_calls} model calls.")
+    return {"status": status, "model_calls": model_calls, "results": results}
@@ -18,12 +18,36 @@ class QueryDatabaseInput(BaseModel):
     """Input schema for the database query tool."""
     pass
 
+def format_records_table(records: List[Dict[str, Any]]) -> str:
+    """
+    Renders records as the Rich text table this tool used to return. The agent no longer
+    receives it; it is kept to measure the token cost of the previous tool output.
+    """
+    table = Table(title="Identity Records in Database", show_header=True, header_style="bold magenta")
+    table.add_column("Identity Number", style="cyan", no_wrap=True)
+    table.add_column("Full Name", style="green")
+    table.add_column("Date of Birth", style="yellow")
+    table.add_column("Timestamp (UTC)", style="dim")
+
+    for record in records:
+        table.add_row(
+            record["identity_number"],
+            record["full_name"],
+            record["date_of_birth"],
+            record["timestamp"]
+        )
+
+    # To return the table as a string, we capture the console output.
+    console = Console(record=True, width=120)
+    console.print(table)
+    return console.export_text()
+
 @tool("query_database_tool", args_schema=QueryDatabaseInput)
-def query_database_tool() -> str:
+def query_database_tool() -> List[Dict[str, Any]] | str:
     """
     Queries the database to fetch all existing identity records.
     Use this tool when the user asks to see or list all data in the database.
-    Returns the data as a neatly formatted string table.
+    Returns the records as a list of rows, or a message if there are none.
     """
     try:
         conn = sqlite3.connect(DB_FILE)
@@ -37,25 +61,8 @@ def query_database_tool() -> str:
         if not records:
             return "The database is currently empty. No records found."
 
-        # --- Use the 'Rich' library to create a beautiful table for the output ---
-        table = Table(title="Identity Records in Database", show_header=True, header_style="bold magenta")
-        table.add_column("Identity Number", style="cyan", no_wrap=True)
-        table.add_column("Full Name", style="green")
-        table.add_column("Date of Birth", style="yellow")
-        table.add_column("Timestamp (UTC)", style="dim")
-
-        for record in records:
-            table.add_row(
-                record["identity_number"],
-                record["full_name"],
-                record["date_of_birth"],
-                record["timestamp"]
-            )
-        
-        # To return the table as a string, we capture the console output.
-        console = Console(record=True, width=120)
-        console.print(table)
-        return console.export_text()
+        # Plain rows keep the tool result compact; the agent formats them for the user.
+        return [dict(record) for record in records]
 
     except sqlite3.Error as e:
         logger.error(f"A database error occurred during query: {e}")